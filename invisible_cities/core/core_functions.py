@@ -191,7 +191,7 @@ def dict_map(func, dic):
     return {key: func(val) for key, val in dic.items()}
 
 
-def df_map(func, df, field):
+def df_map(func, df, field, vectorized=False):
     """Apply map to some data frame field.
 
     Parameters
@@ -202,6 +202,12 @@ def df_map(func, df, field):
         DataFrame containing field.
     field : string
         Label of the DataFrame column.
+    vectorized : bool, optional
+        If True, func is called once with the whole column as a
+        np.ndarray and must return an array of the same length, which
+        is much faster for ufuncs and arithmetic expressions.
+        Otherwise (default), func is applied to each element of the
+        column, as stored in df.
 
     Returns
     -------
@@ -210,7 +216,8 @@ def df_map(func, df, field):
         func.
     """
     out = df.copy()
-    out[field] = list(map(func, out[field]))
+    if vectorized: out[field] = func(out[field].to_numpy())
+    else         : out[field] = list(map(func, out[field]))
     return out
 
 
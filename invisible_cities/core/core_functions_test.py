@@ -214,7 +214,7 @@ def test_np_range(start, stop, step):
     y = x[1:  ]
     z = x[ :-1]
     steps = y - z
-    npt.assert_almost_equal(steps, step)
+    npt.assert_allclose(steps, step, rtol=1e-7, atol=1e-10)
     npt.assert_array_equal(x, np.arange(start, stop, step))
 
 # Check that the sum of the forward and reverse ranges is the same
@@ -225,7 +225,7 @@ def test_np_reverse_range(start, stop, step):
     reverse = core.np_reverse_range(start, stop, step)
     summed = forward + reverse
     if len(summed):
-        npt.assert_almost_equal(summed, summed[0])
+        npt.assert_allclose(summed, summed[0], rtol=1e-7, atol=1e-10)
 
 @given(integers(min_value=0, max_value=99), sane_floats())
 def test_np_constant(N, k):
@@ -257,6 +257,47 @@ def test_df_map():
     l2 = core.df_map(lambda x: x*1000, leptons, 'mass')
     assert l2.mass.values[0] == 511
 
+def test_df_map_vectorized():
+    d = {'q' : [-1, +1, -1],
+         'mass' : [0.511, 105., 1776.]}
+
+    leptons = pd.DataFrame(d,index=['e-', 'mu+', 'tau-'])
+    l2 = core.df_map(lambda x: x*1000, leptons, 'mass', vectorized=True)
+    assert l2.mass.values[0] == 511
+
+    l3 = core.df_map(lambda v: v - np.mean(v), leptons, 'mass', vectorized=True)
+    assert np.allclose(l3.mass.values, leptons.mass.values - np.mean(leptons.mass.values))
+
+def test_df_map_is_elementwise_by_default():
+    d = {'q' : [-1, +1, -1],
+         'mass' : [0.511, 105., 1776.]}
+
+    leptons = pd.DataFrame(d,index=['e-', 'mu+', 'tau-'])
+    l2 = core.df_map(lambda v: v - np.mean(v), leptons, 'mass')
+    assert l2.mass.tolist() == [0, 0, 0]
+
+def test_df_map_non_vectorized_function():
+    d = {'q' : [-1, +1, -1],
+         'mass' : [0.511, 105., 1776.]}
+
+    leptons = pd.DataFrame(d,index=['e-', 'mu+', 'tau-'])
+    l2 = core.df_map(lambda x: "heavy" if x > 1 else "light", leptons, 'mass')
+    assert l2.mass.tolist() == ["light", "heavy", "heavy"]
+    assert leptons.mass.values[0] == 0.511
+
+def test_df_map_string_method():
+    d = {'name' : ['e', 'mu', 'tau'],
+         'mass' : [0.511, 105., 1776.]}
+
+    leptons = pd.DataFrame(d)
+    l2 = core.df_map(lambda s: s.upper(), leptons, 'name')
+    assert l2.name.tolist() == ['E', 'MU', 'TAU']
+
+def test_df_map_keeps_pandas_element_types():
+    df = pd.DataFrame(dict(t = pd.to_datetime(['2020-01-01', '2021-06-15'])))
+    l2 = core.df_map(lambda t: t.year, df, 't')
+    assert l2.t.tolist() == [2020, 2021]
+
 def test_dict_filter_by_value():
     core.dict_filter_by_value(lambda x: x>5,
       {'a':1,'b':20,'c':3,'d':40}) == {'b': 20, 'd': 40}
@@ -303,7 +344,7 @@ def test_define_window():
     sgn = np.random.normal(mu, sigma, 10000)
     n, _ = np.histogram(sgn, 50)
     n0, n1 = core.define_window(n, window_size=10)
-    peak = core.loc_elem_1d(n, np.max(n))
+    peak = np.argmax(n)
     assert n0 == peak - 10
     assert n1 == peak + 10
 
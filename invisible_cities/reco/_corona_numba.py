@@ -0,0 +1,155 @@
+"""
+Compiled version of the main loop of `corona`. Numba is an optional
+dependency: if it cannot be imported, `NUMBA_AVAILABLE` is False and
+`corona` falls back to its pure NumPy implementation.
+"""
+import numpy as np
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+# Status codes returned by `_corona_core`
+CORONA_OK          = 0
+CORONA_EMPTY       = 1
+CORONA_ZERO_CHARGE = 2
+
+
+def _corona_core( xs           : np.ndarray # (n,)
+                , ys           : np.ndarray # (n,)
+                , qs           : np.ndarray # (n,)
+                , Qlm          : float
+                , lm_r2        : float
+                , new_lm_r2    : float
+                , msipm        : int
+                , masked_xs    : np.ndarray # (m,)
+                , masked_ys    : np.ndarray # (m,)
+                , masked_flags : np.ndarray # (m,)
+                ):
+    """
+    Main loop of `corona` (see its docstring for the description of
+    the algorithm). Distances are compared in squared form, so
+    `lm_r2` and `new_lm_r2` are the squared radii. The SiPMs already
+    used are removed by compacting an index array, leaving the input
+    arrays untouched. Positions are given as separate x and y arrays
+    so that each coordinate is read with unit stride.
+
+    Returns
+    -------
+    clusters : np.ndarray with shape (k, 6)
+        One row per cluster with (Q, x, y, var_x, var_y, nsipm)
+
+    status : int
+        One of `CORONA_OK`, `CORONA_EMPTY` or `CORONA_ZERO_CHARGE`.
+        The latter two mirror the exceptions raised by `barycenter`
+        for an empty selection or a selection with no charge.
+    """
+    n         = len(qs)
+    live      = np.arange(n)
+    nlive     = n
+    selected  = np.empty(n, dtype=np.int64)
+    clusters  = np.empty((n, 6))
+    nclusters = 0
+
+    while nlive > 0:
+        jhottest = np.argmax(qs[live[:nlive]]) # SiPM with largest Q
+        hottest  = live[jhottest]
+        if qs[hottest] < Qlm: break            # largest Q remaining is negligible
+
+        # new local maximum of charge from the SiPMs within lm_radius of
+        # hottest, relative to it and summed in index order, like
+        # `_weighted_centroid` does
+        cx   = xs[hottest]
+        cy   = ys[hottest]
+        qsum = 0.
+        sx   = 0.
+        sy   = 0.
+        for j in range(nlive):
+            i  = live[j]
+            dx = xs[i] - cx
+            dy = ys[i] - cy
+            if dx*dx + dy*dy <= lm_r2:
+                qsum += qs[i]
+                sx   += qs[i] * dx
+                sy   += qs[i] * dy
+
+        if qsum == 0: return clusters[:nclusters], CORONA_ZERO_CHARGE
+        cx += sx / qsum
+        cy += sy / qsum
+
+        # SiPMs within new_lm_radius of the new local maximum. The mean
+        # is accumulated relative to the local maximum for stability
+        nsel = 0
+        qsum = 0.
+        sx   = 0.
+        sy   = 0.
+        for j in range(nlive):
+            i  = live[j]
+            dx = xs[i] - cx
+            dy = ys[i] - cy
+            if dx*dx + dy*dy <= new_lm_r2:
+                selected[nsel] = j
+                nsel += 1
+                qsum += qs[i]
+                sx   += qs[i] * dx
+                sy   += qs[i] * dy
+
+        nmasked = 0
+        for k in range(len(masked_flags)):
+            if not masked_flags[k]: continue
+            dx = masked_xs[k] - cx
+            dy = masked_ys[k] - cy
+            if dx*dx + dy*dy <= new_lm_r2:
+                nmasked += 1
+
+        if nsel >= msipm - nmasked:
+            if nsel == 0: return clusters[:nclusters], CORONA_EMPTY
+            if qsum == 0: return clusters[:nclusters], CORONA_ZERO_CHARGE
+            mx  = cx + sx / qsum
+            my  = cy + sy / qsum
+
+            # variance in a second pass around the mean, like
+            # `weighted_mean_and_var`, which avoids the cancellation
+            # of <x^2> - <x>^2 for narrow clusters
+            sxx = 0.
+            syy = 0.
+            for k in range(nsel):
+                i   = live[selected[k]]
+                dx  = xs[i] - mx
+                dy  = ys[i] - my
+                sxx += qs[i] * dx * dx
+                syy += qs[i] * dy * dy
+
+            clusters[nclusters, 0] = qsum
+            clusters[nclusters, 1] = mx
+            clusters[nclusters, 2] = my
+            clusters[nclusters, 3] = sxx / qsum
+            clusters[nclusters, 4] = syy / qsum
+            clusters[nclusters, 5] = nsel
+            nclusters += 1
+
+        # discard the SiPMs contributing to this cluster, or the seed
+        # if there are none, keeping the remaining ones in their
+        # original order
+        if nsel == 0:
+            selected[0] = jhottest
+            nsel        = 1
+
+        write = 0
+        k     = 0
+        for j in range(nlive):
+            if k < nsel and selected[k] == j:
+                k += 1
+                continue
+            live[write] = live[j]
+            write += 1
+        nlive = write
+
+    return clusters[:nclusters], CORONA_OK
+
+
+if NUMBA_AVAILABLE:
+    _corona_core = njit(cache=True)(_corona_core)
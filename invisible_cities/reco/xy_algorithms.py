@@ -1,7 +1,10 @@
-import sys
 import numpy  as np
 import pandas as pd
 
+from dataclasses   import dataclass
+
+from scipy.spatial import cKDTree
+
 from .. core.core_functions  import weighted_mean_and_var
 from .. core                 import system_of_units as units
 from .. core.exceptions      import SipmEmptyList
@@ -14,6 +17,11 @@ from .. core.configure       import check_annotations
 from .. types.ic_types       import xy
 from .. evm.event_model      import Cluster
 
+from .  _corona_numba        import NUMBA_AVAILABLE
+from .  _corona_numba        import CORONA_EMPTY
+from .  _corona_numba        import CORONA_ZERO_CHARGE
+from .  _corona_numba        import _corona_core
+
 from typing import Optional
 from typing import Sequence
 from typing import Tuple
@@ -44,7 +52,7 @@ def threshold_check( pos : np.ndarray # (n, 2)
     if not len(pos)   : raise SipmEmptyList
     if np.sum(qs) == 0: raise SipmZeroCharge
 
-    above_threshold = np.where(qs >= thr)[0]
+    above_threshold = qs >= thr
     pos, qs = pos[above_threshold], qs[above_threshold]
 
     if not len(pos)   : raise SipmEmptyListAboveQthr
@@ -81,8 +89,45 @@ def barycenter( pos : np.ndarray # (n, 2)
     wrap in a list to maintain the same interface.
     """
     pos, qs = threshold_check(pos, qs, Qthr)
+    qsum, mu, var, n = _barycenter_raw(pos, qs)
+    return [Cluster(qsum, xy(*mu), xy(*var), n)]
+
+
+def _barycenter_raw( pos : np.ndarray # (n, 2)
+                   , qs  : np.ndarray # (n,)
+                   ) -> Tuple[float, np.ndarray, np.ndarray, int]:
+    """
+    Computes the total charge, the weighted mean and variance of the
+    positions and the number of SiPMs, without applying any threshold
+    or building a `Cluster`. See `barycenter`.
+    """
+    if not len(qs): raise SipmEmptyList
+
+    qsum = np.sum(qs)
+    if qsum == 0: raise SipmZeroCharge
+
     mu, var = weighted_mean_and_var(pos, qs, axis=0)
-    return [Cluster(np.sum(qs), xy(*mu), xy(*var), len(qs))]
+    return qsum, mu, var, len(qs)
+
+
+def _weighted_centroid( pos    : np.ndarray # (n, 2)
+                      , qs     : np.ndarray # (n,)
+                      , origin : np.ndarray # (2,)
+                      ) -> Tuple[float, float]:
+    """
+    Returns the charge-weighted mean position of the SiPMs as a
+    plain (x, y) tuple. Used by `corona` to find the new local
+    maximum, which does not require building a `Cluster`. The mean is
+    computed relative to `origin` (the seed), so that a seed with no
+    neighbours yields exactly its own position. The sums are
+    accumulated sequentially in the order of `pos`, as `_corona_core`
+    does, so both backends find exactly the same local maximum.
+    """
+    qsum = np.cumsum(qs)[-1]
+    if qsum == 0: raise SipmZeroCharge
+
+    sx, sy = np.cumsum(qs[:, np.newaxis] * (pos - origin), axis=0)[-1]
+    return origin[0] + sx / qsum, origin[1] + sy / qsum
 
 
 def discard_sipms( indices : np.ndarray   # shape (n,)
@@ -100,21 +145,236 @@ def get_nearby_sipm_inds( center : np.ndarray   # shape (2,)
     Returns the indices of the SiPMs that fall within a transverse
     distance `d` of `center`.
     """
-    return np.where(np.linalg.norm(pos - center, axis=1) <= d)[0]
+    diff = pos - center
+    return np.where(np.einsum("ij,ij->i", diff, diff) <= d * d)[0]
+
+def get_nearby_alive_sipm_inds( center : np.ndarray   # shape (2,)
+                              , d      : float
+                              , tree   : cKDTree
+                              , alive  : np.ndarray): # shape (n,)
+    """
+    Same as `get_nearby_sipm_inds`, but using a KD-tree built over the
+    SiPM positions. Only the SiPMs flagged in `alive` are returned, in
+    increasing order.
+    """
+    indices = _query_within(tree, center, d)
+    return indices[alive[indices]]
+
+def _query_within( tree   : cKDTree
+                 , center : np.ndarray # shape (2,)
+                 , d      : float):
+    """
+    Returns, in increasing order, the indices of the points in `tree`
+    within a distance `d` of `center`. The tree is queried with a
+    slightly larger radius and the squared distances are then compared
+    exactly as in `_corona_core`, so that both backends of `corona`
+    agree on the points lying at a distance of exactly `d`.
+    """
+    indices = np.asarray(tree.query_ball_point(center, d * (1 + 1e-9) + 1e-9), dtype=int)
+    indices = np.sort(indices)
+    dx      = tree.data[indices, 0] - center[0]
+    dy      = tree.data[indices, 1] - center[1]
+    return indices[dx * dx + dy * dy <= d * d]
+
+def _sipm_positions_and_masked(all_sipms : pd.DataFrame) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Extracts, as NumPy arrays, the x and y positions of *all* SiPMs
+    and a boolean array that is True for the masked (inactive) ones.
+    """
+    xs       =  all_sipms.X     .to_numpy(dtype=np.float64)
+    ys       =  all_sipms.Y     .to_numpy(dtype=np.float64)
+    inactive = ~all_sipms.Active.to_numpy(dtype=bool)
+    return xs, ys, inactive
+
+def masked_sipm_tree(all_sipms : pd.DataFrame) -> Tuple[cKDTree, np.ndarray]:
+    """
+    Builds the inputs of `count_masked` from the database entry with
+    the SiPM information: a KD-tree over the positions of *all* SiPMs
+    and a boolean array that is True for the masked (inactive) ones.
+    """
+    xs, ys, inactive = _sipm_positions_and_masked(all_sipms)
+    return cKDTree(np.column_stack((xs, ys))), inactive
 
-def count_masked( center    : np.ndarray   # shape (2,)
-                , d         : float
-                , all_sipms : pd.DataFrame
+def count_masked( center      : np.ndarray   # shape (2,)
+                , d           : float
+                , masked_tree : cKDTree
+                , inactive    : np.ndarray   # shape (n,)
                 ):
     """
     Count the number of masked (inactive) SiPMs within a distance `d`
     of `center`. Note that, unlike `get_nearby_sipm_inds`, this
-    function is meant to be called with *all* SiPMs.
+    function is meant to be called with *all* SiPMs, through the
+    output of `masked_sipm_tree`.
     """
-    pos     =  all_sipms.filter(list("XY"))
-    masked  = ~all_sipms.Active.values.astype(bool) # True if masked
-    indices = get_nearby_sipm_inds(center, d, pos)
-    return masked[indices].sum()
+    indices = _query_within(masked_tree, center, d)
+    return np.count_nonzero(inactive[indices])
+
+
+@dataclass(frozen=True)
+class CoronaContext:
+    """
+    SiPM data used by `corona` that depends only on the event and on
+    `Qthr`. Built by `prepare_corona_context`. The KD-trees are only
+    built for the NumPy backend.
+    """
+    pos         : np.ndarray                # (n, 2) positions of the SiPMs above Qthr
+    qs          : np.ndarray                # (n,)   charges   of the SiPMs above Qthr
+    masked_xs   : Optional[np.ndarray]      # (m,)   x of all SiPMs      (if consider_masked)
+    masked_ys   : Optional[np.ndarray]      # (m,)   y of all SiPMs      (if consider_masked)
+    inactive    : Optional[np.ndarray]      # (m,)   True if masked      (if consider_masked)
+    tree        : Optional[cKDTree] = None  # KD-tree over `pos`
+    masked_tree : Optional[cKDTree] = None  # KD-tree over all SiPMs     (if consider_masked)
+
+
+def _corona_trees( pos       : np.ndarray             # (n, 2)
+                 , masked_xs : Optional[np.ndarray]   # (m,)
+                 , masked_ys : Optional[np.ndarray]): # (m,)
+    """
+    Builds the KD-trees used by the NumPy backend of `corona`. The
+    masked-SiPM tree is None if masked SiPMs are not considered.
+    """
+    tree = cKDTree(pos)
+    if masked_xs is None: return tree, None
+    return tree, cKDTree(np.column_stack((masked_xs, masked_ys)))
+
+
+def prepare_corona_context( pos             : np.ndarray # (n, 2)
+                          , qs              : np.ndarray # (n,)
+                          , all_sipms       : pd.DataFrame
+                          , Qthr            : float
+                          , consider_masked : Optional[bool] = False) -> CoronaContext:
+    """
+    Applies the charge threshold and builds the structures used by
+    `corona` that depend only on the event and on `Qthr`. The output
+    can be passed to `corona_from_context` several times, e.g. to run
+    `corona` with different parameters on the same event, without
+    repeating this step. See `corona` for the meaning of the
+    arguments.
+    """
+    # no-op if the input is already contiguous and double precision
+    pos = np.ascontiguousarray(pos, dtype=np.float64)
+    qs  = np.ascontiguousarray(qs , dtype=np.float64)
+
+    pos, qs = threshold_check(pos, qs, Qthr)
+
+    if consider_masked: masked_xs, masked_ys, inactive = _sipm_positions_and_masked(all_sipms)
+    else              : masked_xs = masked_ys = inactive = None
+
+    if NUMBA_AVAILABLE: tree = masked_tree = None
+    else              : tree, masked_tree = _corona_trees(pos, masked_xs, masked_ys)
+
+    return CoronaContext(pos, qs, masked_xs, masked_ys, inactive, tree, masked_tree)
+
+
+def corona_from_context( ctx           : CoronaContext
+                       , Qlm           : float
+                       , lm_radius     : float
+                       , new_lm_radius : float
+                       , msipm         : int) -> Sequence[Cluster]:
+    """
+    Runs `corona` on the output of `prepare_corona_context`. Masked
+    SiPMs are considered if they were when preparing `ctx`. See
+    `corona` for the meaning of the arguments.
+    """
+    assert     lm_radius >= 0,     "lm_radius must be non-negative"
+    assert new_lm_radius >= 0, "new_lm_radius must be non-negative"
+
+    corona_loop = _corona_compiled if NUMBA_AVAILABLE else _corona_numpy
+    c = corona_loop(ctx, Qlm, lm_radius, new_lm_radius, msipm)
+
+    if not len(c): raise ClusterEmptyList
+
+    return c
+
+
+def _corona_numpy( ctx           : CoronaContext
+                 , Qlm           : float
+                 , lm_radius     : float
+                 , new_lm_radius : float
+                 , msipm         : int) -> Sequence[Cluster]:
+    """
+    Main loop of `corona` implemented with NumPy.
+    """
+    pos, qs, inactive = ctx.pos, ctx.qs, ctx.inactive
+
+    if ctx.tree is None: tree, masked_tree = _corona_trees(pos, ctx.masked_xs, ctx.masked_ys)
+    else               : tree, masked_tree = ctx.tree, ctx.masked_tree
+
+    # SiPMs are discarded by flagging them in `alive`, so `pos` and
+    # `qs` are never copied
+    alive = np.ones(len(qs), dtype=bool)
+
+    # Only SiPMs with charge above Qlm can seed a cluster. Sorting
+    # them once by decreasing charge (ties by index, like np.argmax)
+    # means the first one still alive is the SiPM with largest Q. A
+    # seed is not necessarily discarded in its own iteration, so the
+    # search restarts from the same position in the next one.
+    candidates = np.flatnonzero(qs >= Qlm)
+    candidates = candidates[np.argsort(-qs[candidates], kind="stable")]
+    first      = 0
+
+    c  = []
+    # While there are more local maxima
+    while True:
+        while first < len(candidates) and not alive[candidates[first]]:
+            first += 1
+        if first == len(candidates): break
+
+        hottest_sipm = candidates[first] # SiPM with largest Q
+
+        # find new local maximum of charge considering all SiPMs within lm_radius of hottest_sipm
+        within_lm_radius  = get_nearby_alive_sipm_inds(pos[hottest_sipm], lm_radius, tree, alive)
+        new_local_maximum = _weighted_centroid(pos[within_lm_radius], qs[within_lm_radius], pos[hottest_sipm])
+
+        # find the SiPMs within new_lm_radius of the new local maximum of charge
+        within_new_lm_radius = get_nearby_alive_sipm_inds(new_local_maximum, new_lm_radius, tree, alive)
+        n_masked_neighbours  = count_masked              (new_local_maximum, new_lm_radius, masked_tree, inactive) if masked_tree is not None else 0
+
+        # if there are at least msipms within_new_lm_radius, taking
+        # into account any masked channel, get the barycenter
+        if len(within_new_lm_radius) >= msipm - n_masked_neighbours:
+            qsum, mu, var, n = _barycenter_raw(pos[within_new_lm_radius], qs[within_new_lm_radius])
+            c.append(Cluster(qsum, xy(*mu), xy(*var), n))
+
+        # discard the SiPMs contributing to this cluster, or the
+        # seed if there are none, so that the loop always progresses
+        alive[within_new_lm_radius] = False
+        if not len(within_new_lm_radius): alive[hottest_sipm] = False
+
+    return c
+
+
+def _corona_compiled( ctx           : CoronaContext
+                    , Qlm           : float
+                    , lm_radius     : float
+                    , new_lm_radius : float
+                    , msipm         : int) -> Sequence[Cluster]:
+    """
+    Main loop of `corona` using `_corona_core`, compiled with Numba
+    when available. Same interface as `_corona_numpy`.
+    """
+    xs = np.ascontiguousarray(ctx.pos[:, 0])
+    ys = np.ascontiguousarray(ctx.pos[:, 1])
+
+    if ctx.inactive is not None:
+        masked_xs    = ctx.masked_xs
+        masked_ys    = ctx.masked_ys
+        masked_flags = ctx.inactive
+    else:
+        masked_xs    = np.empty(0, dtype=np.float64)
+        masked_ys    = np.empty(0, dtype=np.float64)
+        masked_flags = np.empty(0, dtype=bool)
+
+    clusters, status = _corona_core( xs, ys, ctx.qs, Qlm
+                                   ,     lm_radius *     lm_radius
+                                   , new_lm_radius * new_lm_radius
+                                   , msipm, masked_xs, masked_ys, masked_flags)
+
+    if status == CORONA_EMPTY      : raise SipmEmptyList
+    if status == CORONA_ZERO_CHARGE: raise SipmZeroCharge
+
+    return [Cluster(Q, xy(x, y), xy(varx, vary), int(n))
+            for Q, x, y, varx, vary, n in clusters]
 
 
 @check_annotations
@@ -137,7 +397,8 @@ def corona( pos             : np.ndarray # (n, 2)
       of the new local maximum
     - creating a cluster from the SiPMs neighbouring the barycenter of
       the new local maximum, provided it contains at least `msipm`
-    - discarding (non-destructively) the sipms that formed the cluster
+    - discarding (non-destructively) the sipms that formed the cluster,
+      or the SiPM with highest charge if none was found
     - repeating the previous steps until there are no more SiPMs with
       charge higher than `Qlm`
 
@@ -225,34 +486,5 @@ def corona( pos             : np.ndarray # (n, 2)
            consider_masked = True)
 
     """
-    assert     lm_radius >= 0,     "lm_radius must be non-negative"
-    assert new_lm_radius >= 0, "new_lm_radius must be non-negative"
-
-    pos, qs = threshold_check(pos, qs, Qthr)
-
-    c  = []
-    # While there are more local maxima
-    while len(qs) > 0:
-
-        hottest_sipm = np.argmax(qs)       # SiPM with largest Q
-        if qs[hottest_sipm] < Qlm: break   # largest Q remaining is negligible
-
-        # find new local maximum of charge considering all SiPMs within lm_radius of hottest_sipm
-        within_lm_radius  = get_nearby_sipm_inds(pos[hottest_sipm], lm_radius, pos)
-        new_local_maximum = barycenter(pos[within_lm_radius], qs[within_lm_radius])[0].posxy
-
-        # find the SiPMs within new_lm_radius of the new local maximum of charge
-        within_new_lm_radius = get_nearby_sipm_inds(new_local_maximum, new_lm_radius, pos      )
-        n_masked_neighbours  = count_masked        (new_local_maximum, new_lm_radius, all_sipms) if consider_masked else 0
-
-        # if there are at least msipms within_new_lm_radius, taking
-        # into account any masked channel, get the barycenter
-        if len(within_new_lm_radius) >= msipm - n_masked_neighbours:
-            c.extend(barycenter(pos[within_new_lm_radius], qs[within_new_lm_radius]))
-            # delete the SiPMs contributing to this cluster
-
-        pos, qs = discard_sipms(within_new_lm_radius, pos, qs)
-
-    if not len(c): raise ClusterEmptyList
-
-    return c
+    ctx = prepare_corona_context(pos, qs, all_sipms, Qthr, consider_masked)
+    return corona_from_context(ctx, Qlm, lm_radius, new_lm_radius, msipm)
@@ -1,12 +1,16 @@
 import numpy  as np
 import pandas as pd
 
-from functools import partial
+from functools   import partial
+from dataclasses import FrozenInstanceError
 
 from pytest import fixture
 from pytest import mark
 from pytest import raises
+from pytest import approx
+from pytest import param
 parametrize = mark.parametrize
+from scipy.spatial import cKDTree
 
 from hypothesis             import given
 from hypothesis             import settings
@@ -26,9 +30,20 @@ from .. core.exceptions      import SipmZeroCharge
 
 from .       xy_algorithms   import corona
 from .       xy_algorithms   import barycenter
+from .       xy_algorithms   import _weighted_centroid
+from .       xy_algorithms   import _barycenter_raw
 from .       xy_algorithms   import discard_sipms
 from .       xy_algorithms   import get_nearby_sipm_inds
+from .       xy_algorithms   import get_nearby_alive_sipm_inds
 from .       xy_algorithms   import count_masked
+from .       xy_algorithms   import masked_sipm_tree
+from .       xy_algorithms   import prepare_corona_context
+from .       xy_algorithms   import corona_from_context
+from .       xy_algorithms   import _corona_numpy
+from .       xy_algorithms   import _corona_compiled
+from .                       import xy_algorithms
+from .       _corona_numba   import NUMBA_AVAILABLE
+from .       _corona_numba   import _corona_core
 
 
 @composite
@@ -111,6 +126,16 @@ def datasipm_3x5():
     return _create_fake_datasipm(x, y, active)
 
 
+@fixture(params=("python", param("numba", marks=mark.skipif(not NUMBA_AVAILABLE,
+                                                             reason="numba is not installed"))))
+def corona_kernel(request, monkeypatch):
+    # Runs a test with the pure Python `_corona_core` and, if numba is
+    # installed, with the compiled one
+    if request.param == "python":
+        monkeypatch.setattr(xy_algorithms, "_corona_core", getattr(_corona_core, "py_func", _corona_core))
+    return request.param
+
+
 @fixture(scope="session")
 def datasipm5x5():
     # Create fake database with this 5 x 5 grid of SiPMs:
@@ -173,6 +198,29 @@ def test_barycenter_single_cluster_generic(p_q):
     assert len(clusters) == 1
 
 
+@given(positions_and_qs())
+@settings(max_examples=100)
+def test_weighted_centroid_matches_barycenter(p_q):
+    pos, qs = p_q
+    B = barycenter(pos, qs)[0]
+    assert np.allclose(_weighted_centroid(pos, qs, pos[0]), B.XY)
+
+
+@given(positions_and_qs(max_value=1))
+def test_weighted_centroid_single_sipm_is_exact(p_q):
+    pos, qs = p_q
+    assert _weighted_centroid(pos, qs, pos[0]) == tuple(pos[0])
+
+
+@parametrize("pos qs exception".split(),
+             ((np.empty((0, 2)), np.array([])    , SipmEmptyList ),
+              (np.ones ((2, 2)), np.array([0, 0]), SipmZeroCharge),
+              (np.ones ((2, 2)), np.array([1,-1]), SipmZeroCharge)))
+def test_barycenter_raw_raises(pos, qs, exception):
+    with raises(exception):
+        _barycenter_raw(pos, qs)
+
+
 corona_default = partial( corona
                         , all_sipms = DataSiPM("new", 0)
                         , Qthr = 0., Qlm = 0.
@@ -186,9 +234,10 @@ def test_raises_sipm_empty_list(algorithm):
 
 
 @parametrize("algorithm", (barycenter, corona_default))
-def test_raises_sipm_zero_charge(algorithm):
+@parametrize("qs", ([0, 0], [1, -1]))
+def test_raises_sipm_zero_charge(algorithm, qs):
     with raises(SipmZeroCharge):
-        algorithm(np.array([[1, 2], [3, 4]]), np.array([0, 0]))
+        algorithm(np.array([[1, 2], [3, 4]]), np.array(qs))
 
 
 def test_corona_converges_to_barycenter(toy_sipm_signal, datasipm):
@@ -272,6 +321,66 @@ def test_corona_simple_examples(toy_sipm_signal, datasipm, Qlm, rmax, nclusters)
     assert len(clusters) == nclusters
 
 
+def test_corona_seed_survives_its_first_cluster(datasipm):
+    # With lm_radius > new_lm_radius, the first cluster is formed by the
+    # SiPMs at x = 3 and 3.5 and leaves the hottest one alive, which
+    # must seed a second cluster
+    pos = np.array([[0, 0], [3, 0], [3.5, 0]], dtype=float)
+    qs  = np.array([10, 9.9, 9.9])
+    clusters = corona(pos, qs, datasipm,
+                      Qthr          = 0,
+                      Qlm           = 1   * units.pes,
+                          lm_radius = 5   * units.mm,
+                      new_lm_radius = 1.5 * units.mm,
+                      msipm         = 1)
+
+    assert len(clusters) == 2
+    assert clusters[0].Q == approx(19.8)
+    assert clusters[1].Q == approx(10  )
+    assert clusters[1].XY == (0, 0)
+
+
+def test_corona_discards_seed_without_neighbours(datasipm):
+    # The new local maximum of the hottest SiPM falls between both
+    # SiPMs, with none of them within new_lm_radius
+    pos = np.array([[0, 0], [4, 0]], dtype=float)
+    qs  = np.array([10, 9])
+    clusters = corona(pos, qs, datasipm,
+                      Qthr          = 0,
+                      Qlm           = 1   * units.pes,
+                          lm_radius = 5   * units.mm,
+                      new_lm_radius = 1.5 * units.mm,
+                      msipm         = 1)
+
+    assert len(clusters)  == 1
+    assert clusters[0].Q  == 9
+    assert clusters[0].XY == (4, 0)
+
+
+def test_corona_null_radii_one_cluster_per_sipm(datasipm):
+    # With null radii each seed must find itself, so every SiPM above
+    # Qlm forms a cluster on its own. Non-integer charges make sure
+    # the new local maximum does not drift away from the seed
+    rng  = np.random.default_rng(123)
+    pos  = datasipm[["X", "Y"]].to_numpy()[:200]
+    qs   = rng.uniform(0.1, 10, size=len(pos))
+    Qlm  = 5 * units.pes
+    clusters = corona(pos, qs, datasipm,
+                      Qthr          = 0,
+                      Qlm           = Qlm,
+                          lm_radius = 0,
+                      new_lm_radius = 0,
+                      msipm         = 1)
+
+    above    = qs >= Qlm
+    order    = np.argsort(-qs[above])
+    clusters = sorted(clusters, key=lambda c: -c.Q)
+    assert len(clusters) == np.count_nonzero(above)
+    assert all(c.nsipm == 1 for c in clusters)
+    assert np.array_equal([c.Q  for c in clusters], qs [above][order])
+    assert np.allclose   ([c.XY for c in clusters], pos[above][order])
+
+
 def test_corona_Qlm_too_high_raises_ClusterEmptyList(toy_sipm_signal, datasipm):
     pos, qs  = toy_sipm_signal
     Qlm      = max(qs) * 1.1 * units.pes
@@ -298,6 +407,29 @@ def test_corona_Qthr_too_high_raises_SipmEmptyListAboveQthr(toy_sipm_signal, dat
                new_lm_radius  =        np.inf)
 
 
+@parametrize("consider_masked", (False, True))
+def test_corona_from_context_can_be_reused(datasipm_3x5, consider_masked):
+    datasipm = datasipm_3x5
+    pos      = np.stack((datasipm.X.values, datasipm.Y.values), axis=1)
+    qs       = np.array([1, 1, 1, 1, 5, 0, 1, 1, 1, 1, 6, 1, 1, 1, 1])
+    params   = dict(Qlm=4 * units.pes, lm_radius=0, new_lm_radius=1.5 * units.mm, msipm=6)
+    ctx      = prepare_corona_context(pos, qs, datasipm, 0, consider_masked)
+
+    for _ in range(2):
+        clusters = corona_from_context(ctx, **params)
+        expected = corona(pos, qs, datasipm, Qthr=0, consider_masked=consider_masked, **params)
+        assert len(clusters) == len(expected)
+        for got, exp in zip(clusters, expected):
+            assert_cluster_equality(got, exp)
+
+
+def test_corona_context_is_frozen(toy_sipm_signal, datasipm):
+    pos, qs = toy_sipm_signal
+    ctx     = prepare_corona_context(pos, qs, datasipm, 0)
+    with raises(FrozenInstanceError):
+        ctx.qs = qs
+
+
 def test_discard_sipms(toy_sipm_signal_and_inds):
     k, i, pos, qs = toy_sipm_signal_and_inds
     xysel, qsel = discard_sipms(i, pos, qs)
@@ -321,12 +453,30 @@ def test_get_nearby_sipm_inds():
         else       : assert np.sqrt((xs[i] - xc)**2 + (ys[i] - yc)**2) >  d
 
 
+def test_get_nearby_alive_sipm_inds():
+    xs    = np.array([0, 1, 2, 3, 4, 0, 1, 2, 3, 4, 0, 1, 2, 3, 4])
+    ys    = np.array([0, 0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 3, 4, 4, 4])
+    pos   = np.stack((xs, ys), axis=1)
+    alive = np.arange(len(xs)) % 3 != 0
+    c     = np.array((2, 2))
+    d     = 1.5
+    sis   = get_nearby_alive_sipm_inds(c, d, cKDTree(pos), alive)
+    expected = np.intersect1d(get_nearby_sipm_inds(c, d, pos), np.flatnonzero(alive))
+    assert np.array_equal(np.sort(sis), expected)
+
+
+def test_masked_sipm_tree(datasipm_3x5):
+    tree, inactive = masked_sipm_tree(datasipm_3x5)
+    assert tree.n == len(datasipm_3x5)
+    assert np.array_equal(np.flatnonzero(inactive), [5])
+
+
 def test_count_masked_all_active(datasipm_all_active):
     xy0 = np.array([0, 0], dtype=float)
     is_masked = datasipm_all_active.Active.values
 
     # All sipms are active in run number 1
-    assert count_masked(xy0, np.inf, datasipm_all_active) == 0
+    assert count_masked(xy0, np.inf, *masked_sipm_tree(datasipm_all_active)) == 0
 
 
 @mark.parametrize("sipm_id  radius  expected_nmasked".split(),
@@ -343,7 +493,7 @@ def test_count_masked_near_masked(datasipm_5000, sipm_id, radius, expected_nmask
 
     # small smear so the search point doesn't fall exactly at sipm position
     masked_xy   += np.random.normal(0, 0.001 * radius, size=2)
-    assert count_masked(masked_xy, radius, datasipm_5000) == expected_nmasked
+    assert count_masked(masked_xy, radius, *masked_sipm_tree(datasipm_5000)) == expected_nmasked
 
 
 def test_masked_channels(datasipm_3x5):
@@ -425,3 +575,89 @@ def test_corona_finds_masked_sipms_correctly(datasipm5x5):
 
     assert len(c)     ==  1
     assert c[0].nsipm == 17
+
+
+@mark.skipif(not NUMBA_AVAILABLE, reason="numba is not installed")
+def test_corona_kernel_is_compiled():
+    assert hasattr(xy_algorithms._corona_core, "py_func")
+
+
+def assert_backends_agree(ctx, Qlm, lm_radius, new_lm_radius, msipm):
+    args = (ctx, Qlm, lm_radius, new_lm_radius, msipm)
+    numpy_clusters  = _corona_numpy   (*args)
+    kernel_clusters = _corona_compiled(*args)
+
+    assert len(numpy_clusters) == len(kernel_clusters)
+    for numpy_cluster, kernel_cluster in zip(numpy_clusters, kernel_clusters):
+        assert_cluster_equality(kernel_cluster, numpy_cluster)
+
+
+@parametrize("consider_masked", (False, True))
+@parametrize("charges", ("integer", "real"))
+@parametrize("lm_radius new_lm_radius msipm".split(),
+             ((0  , 0     , 1),
+              (0  , 1     , 1),
+              (0  , 2     , 1),
+              (0  , 1.5   , 1),
+              (1.5, 0     , 0),
+              (1.5, 1     , 1),
+              (1.5, 1.5   , 3),
+              (1.5, 2     , 1),
+              (3  , 1.5   , 1),
+              (0  , np.inf, 1)))
+def test_corona_backends_agree(corona_kernel, datasipm5x5, lm_radius, new_lm_radius, msipm, charges, consider_masked):
+    datasipm = datasipm5x5
+    pos      = np.stack([datasipm.X.values, datasipm.Y.values], axis=1).astype(float)
+    if charges == "integer": qs = np.arange(len(pos), dtype=float) % 7 + 1
+    else                   : qs = np.random.default_rng(1).uniform(1, 7, size=len(pos))
+    ctx      = prepare_corona_context(pos, qs, datasipm, 0, consider_masked)
+
+    if lm_radius and not new_lm_radius:
+        # no SiPM falls exactly on the new local maximum
+        with raises(SipmEmptyList): _corona_numpy   (ctx, 3, lm_radius, new_lm_radius, msipm)
+        with raises(SipmEmptyList): _corona_compiled(ctx, 3, lm_radius, new_lm_radius, msipm)
+        return
+
+    assert_backends_agree(ctx, 3, lm_radius, new_lm_radius, msipm)
+
+
+@parametrize("lm_radius new_lm_radius msipm".split(),
+             (( 0, 0 , 0),
+              ( 0, 0 , 1),
+              ( 0, 10, 1),
+              (15, 10, 1),
+              ( 0, 20, 1)))
+def test_corona_backends_agree_on_sipm_plane(corona_kernel, datasipm, lm_radius, new_lm_radius, msipm):
+    # Random events on the 10 mm pitch of the SiPM plane, where many
+    # SiPMs lie exactly at new_lm_radius of a lonely seed
+    rng     = np.random.default_rng(2)
+    all_pos = datasipm[["X", "Y"]].to_numpy()
+    for _ in range(20):
+        center = all_pos[rng.integers(len(all_pos))]
+        pos    = all_pos[np.sum((all_pos - center)**2, axis=1) <= 40**2]
+        qs     = rng.uniform(0, 10, size=len(pos))
+        ctx    = prepare_corona_context(pos, qs, datasipm, 1)
+        assert_backends_agree(ctx, 4, lm_radius, new_lm_radius, msipm)
+
+
+@parametrize("pos qs lm_radius new_lm_radius nclusters".split(),
+             (# seed survives its first cluster
+              ([[0, 0], [3, 0], [3.5, 0]], [10, 9.9, 9.9], 5, 1.5, 2),
+              # no SiPM within new_lm_radius of the first local maximum
+              ([[0, 0], [4, 0]          ], [10, 9       ], 5, 1.5, 1)))
+def test_corona_backends_agree_through_corona(corona_kernel, monkeypatch, datasipm,
+                                              pos, qs, lm_radius, new_lm_radius, nclusters):
+    pos     = np.array(pos, dtype=float)
+    qs      = np.array(qs , dtype=float)
+    run     = partial(corona, pos, qs, datasipm,
+                      Qthr = 0, Qlm = 1, msipm = 1,
+                      lm_radius = lm_radius, new_lm_radius = new_lm_radius)
+
+    monkeypatch.setattr(xy_algorithms, "NUMBA_AVAILABLE", False)
+    numpy_clusters  = run()
+    monkeypatch.setattr(xy_algorithms, "NUMBA_AVAILABLE", True)
+    kernel_clusters = run()
+
+    assert len(numpy_clusters) == len(kernel_clusters) == nclusters
+    for numpy_cluster, kernel_cluster in zip(numpy_clusters, kernel_clusters):
+        assert_cluster_equality(kernel_cluster, numpy_cluster)